@@ -1,15 +1,39 @@
 
 # Imports
 import asyncio
+import aiofiles
+import aiohttp
+import orjson
 import yaml
 import logging
-import requests
+import math
+import ssl
+import sys
 import argparse
 import time
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from rich.console import Console
 from rich.logging import RichHandler
 from rich.traceback import install
-from nio import AsyncClient, MatrixRoom, RoomMessageText, RoomMessageImage, RoomMessageAudio, RoomMessageFile
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from nio import (
+    AsyncClient,
+    MatrixRoom,
+    RoomMessageText,
+    RoomMessageImage,
+    RoomMessageAudio,
+    RoomMessageFile,
+    UploadFilterResponse
+)
+
+# Boucle d'événements uvloop (optionnelle, indisponible sous Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# end try
 
 # Configuration des logs avec Rich
 install()
@@ -24,137 +48,525 @@ logging_config = {
 logging.basicConfig(**logging_config)
 logger = logging.getLogger("matrix-bridge")
 
+# Chargeur YAML en C (libyaml) si disponible
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# En-têtes des requêtes envoyées au webhook
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Nombre d'identifiants d'événements récents mémorisés pour le dédoublonnage
+SEEN_EVENTS_SIZE = 4096
+
+# Nouvelles tentatives du webhook (100 ms -> 400 ms -> 1.6 s, avec gigue)
+WEBHOOK_ATTEMPTS = 4
+WEBHOOK_BACKOFF = wait_exponential_jitter(initial=0.1, max=2, exp_base=4, jitter=0.1)
+WEBHOOK_RETRY_STATUSES = {429, 503}
+WEBHOOK_RETRY_AFTER_MAX = 5
+
+# Types de médias transmis au webhook, par type d'événement Matrix
+MEDIA_EVENT_TYPES = {
+    RoomMessageImage: "image",
+    RoomMessageAudio: "audio",
+    RoomMessageFile: "file"
+}
+
+# Webhook delivery queue
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 8
+
+# Regroupement des événements (si n8n.batch_webhook_url est configuré)
+WEBHOOK_BATCH_MAX = 32
+WEBHOOK_BATCH_DELAY = 0.05
+
+# Filtre de synchronisation Matrix (limite la timeline, chargement paresseux des membres)
+SYNC_FILTER_ROOM = {
+    "timeline": {"limit": 20},
+    "state": {"lazy_load_members": True}
+}
+SYNC_TIMEOUT = 30000
+
+# Pool de connexions HTTP persistantes vers n8n
+HTTP_POOL_SIZE = 100
+HTTP_POOL_SIZE_PER_HOST = 32
+HTTP_KEEPALIVE_TIMEOUT = 75
+HTTP_DNS_CACHE_TTL = 300
+HTTP_TIMEOUT = 10
+
+
+@dataclass(slots=True, frozen=True)
+class BotConfig:
+    """
+    Bot configuration, flattened from the YAML file.
+    """
+    homeserver: str
+    user_id: str
+    access_token: str
+    user_password: str
+    room_id: str
+    webhook_url: str
+    batch_webhook_url: str | None = None
+    verify_ssl: bool = False
+    ca_file: str | None = None
+
+    @classmethod
+    def from_dict(cls, config):
+        """
+        Build the configuration from the parsed YAML file.
+
+        Args:
+            config (dict): The parsed YAML configuration
+
+        Returns:
+            BotConfig: The bot configuration
+        """
+        matrix = config["matrix"]
+        return cls(
+            homeserver=matrix["homeserver"],
+            user_id=matrix["user_id"],
+            access_token=matrix["access_token"],
+            user_password=matrix["user_password"],
+            room_id=matrix["room_id"],
+            webhook_url=config["n8n"]["webhook_url"],
+            batch_webhook_url=config["n8n"].get("batch_webhook_url"),
+            verify_ssl=config["n8n"].get("verify_ssl", False),
+            ca_file=config["n8n"].get("ca_file")
+        )
+    # end from_dict
+# end BotConfig
+
+
+async def load_config(config_path):
+    """
+    Read and parse the YAML configuration file.
+
+    Args:
+        config_path (str): Path to the YAML configuration file
+
+    Returns:
+        BotConfig: The bot configuration
+    """
+    async with aiofiles.open(config_path, "r") as f:
+        content = await f.read()
+    # end async with
+    return BotConfig.from_dict(yaml.load(content, Loader=YAML_LOADER))
+# end load_config
+
+
+def create_ssl_context(cfg: BotConfig) -> ssl.SSLContext:
+    """
+    Create the TLS context shared by all webhook connections.
+
+    The certificate of n8n is checked against n8n.ca_file if given, against the
+    system CAs if n8n.verify_ssl is true, and not checked otherwise.
+
+    Args:
+        cfg (BotConfig): The bot configuration
+
+    Returns:
+        ssl.SSLContext: The TLS context
+    """
+    ctx = ssl.create_default_context(cafile=cfg.ca_file)
+    if cfg.ca_file is None and not cfg.verify_ssl:
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    # end if
+    return ctx
+# end create_ssl_context
+
+
+class WebhookError(Exception):
+    """
+    Webhook failure, the delivery is abandoned.
+    """
+
+    def __init__(self, status):
+        """
+        Args:
+            status (int): HTTP status returned by the webhook
+        """
+        super().__init__(f"Webhook returned HTTP {status}")
+        self.status = status
+    # end __init__
+# end WebhookError
+
+
+class WebhookRetryError(WebhookError):
+    """
+    Transient webhook failure, the delivery should be retried.
+    """
+
+    def __init__(self, status, retry_after=None):
+        """
+        Args:
+            status (int): HTTP status returned by the webhook
+            retry_after (float): Delay requested by the Retry-After header, in seconds
+        """
+        super().__init__(status)
+        self.retry_after = retry_after
+    # end __init__
+# end WebhookRetryError
+
+
+def _parse_retry_after(value):
+    """
+    Parse a Retry-After header given in seconds.
+
+    Args:
+        value (str): The header value, or None
+
+    Returns:
+        float: The delay in seconds, or None if missing or not a finite number of seconds
+    """
+    try:
+        delay = float(value)
+    except (TypeError, ValueError):
+        return None
+    # end try
+
+    if not math.isfinite(delay):
+        return None
+    # end if
+    return max(delay, 0.0)
+# end _parse_retry_after
+
+
+def _webhook_wait(retry_state):
+    """
+    Wait before the next webhook attempt, honoring Retry-After when present.
+    """
+    exc = retry_state.outcome.exception()
+    retry_after = getattr(exc, "retry_after", None)
+    if retry_after is not None:
+        return retry_after
+    # end if
+    return WEBHOOK_BACKOFF(retry_state)
+# end _webhook_wait
+
+
+@lru_cache(maxsize=2048)
+def _mxc_to_http(mxc_url: str) -> tuple[str, str] | None:
+    """
+    Convert an mxc:// URI to a media download path (cached).
+
+    Args:
+        mxc_url (str): The mxc:// URI of the media
+
+    Returns:
+        tuple: The download path and the media ID, or None if not a valid mxc:// URI
+    """
+    if not mxc_url.startswith("mxc://"):
+        return None
+    # end if
+
+    server_name, sep, media_id = mxc_url[6:].partition("/")
+    if not sep:
+        return None
+    # end if
+    return f"/_matrix/client/v1/media/download/{server_name}/{media_id}", media_id
+# end _mxc_to_http
+
 
 class MatrixBot(AsyncClient):
     """
     MatrixBot
     """
 
-    def __init__(self, bot_config):
+    # Attributes added to AsyncClient, stored in slots instead of the instance dict
+    __slots__ = (
+        "cfg",
+        "start_timestamp",
+        "last_event_timestamp",
+        "_webhook_url",
+        "_batch_webhook_url",
+        "_homeserver",
+        "_seen",
+        "_seen_deque",
+        "_session",
+        "_tmpl_text",
+        "_tmpl_media",
+        "_queue",
+        "_batches"
+    )
+
+    def __init__(self, cfg: BotConfig):
         """
-        Initialisation du bot avec un fichier de configuration YAML.
+        Initialisation du bot avec la configuration chargée depuis le fichier YAML.
         """
-        self.bot_config = bot_config
-        super().__init__(self.bot_config["matrix"]["homeserver"], self.bot_config["matrix"]["user_id"])
-        self.access_token = self.bot_config["matrix"]["access_token"]
-        self.last_event_timestamp = int(time.time() * 1000)
+        self.cfg = cfg
+        self._webhook_url = cfg.webhook_url
+        self._batch_webhook_url = cfg.batch_webhook_url
+        self._homeserver = cfg.homeserver
+        super().__init__(self._homeserver, cfg.user_id)
+        self.access_token = cfg.access_token
+        self.start_timestamp = int(time.time() * 1000)
+        self.last_event_timestamp = self.start_timestamp
+
+        # Recently handled event IDs (set for lookup, deque for eviction order)
+        self._seen: set[str] = set()
+        self._seen_deque: deque = deque()
+
+        # Shared HTTP session for the webhook, set in main()
+        self._session: aiohttp.ClientSession | None = None
+
+        # Static part of the payloads, by type
+        self._tmpl_text = {"type": "text"}
+        self._tmpl_media = {kind: {"type": kind} for kind in MEDIA_EVENT_TYPES.values()}
+
+        # Payloads waiting to be delivered by the webhook workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+        # Batches waiting to be delivered, when a batch webhook is configured
+        self._batches: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_WORKERS)
     # end __init__
 
     def transform_mxc_url(self, mxc_url) -> tuple:
         """
         Convert a link to a media file to a direct download link.
         """
-        if not mxc_url.startswith("mxc://"):
-            return None
+        return _mxc_to_http(mxc_url)
+    # end transform_mxc_url
+
+    async def create_sync_filter(self):
+        """
+        Upload the sync filter to the homeserver.
+
+        Returns:
+            str | dict: The filter ID, or the filter itself if the upload failed
+        """
+        response = await self.upload_filter(room=SYNC_FILTER_ROOM)
+        if isinstance(response, UploadFilterResponse):
+            return response.filter_id
         # end if
 
-        server_name, media_id = mxc_url.replace("mxc://", "").split("/")
-        return f"/_matrix/client/v1/media/download/{server_name}/{media_id}", media_id
-    # end transform_mxc_url
+        logger.warning("Could not upload the sync filter, sending it inline: %s", response)
+        return {"room": SYNC_FILTER_ROOM}
+    # end create_sync_filter
 
     def check_timestamp(self, event):
         """
-        Check if the event timestamp is greater than the last event timestamp.
+        Check if the event must be handled.
+
+        Events sent before the bot started are ignored, as well as events already
+        handled. Events are not compared to each other by timestamp, as server
+        timestamps are not monotonic across federation.
 
         Args:
             event (nio.events.room_events.RoomEvent): The event to check
 
         Returns:
-            bool: True if the event timestamp is greater than the last event timestamp
+            bool: True if the event is new and was sent after the bot started
         """
-        if event.server_timestamp > self.last_event_timestamp:
-            self.last_event_timestamp = event.server_timestamp
-            return True
+        if event.server_timestamp < self.start_timestamp or event.event_id in self._seen:
+            return False
+        # end if
+
+        self._seen.add(event.event_id)
+        self._seen_deque.append(event.event_id)
+        if len(self._seen_deque) > SEEN_EVENTS_SIZE:
+            self._seen.discard(self._seen_deque.popleft())
         # end if
-        return False
+
+        self.last_event_timestamp = max(self.last_event_timestamp, event.server_timestamp)
+        return True
     # end check_timestamp
 
-    async def message_callback(self, room: MatrixRoom, event: RoomMessageText):
+    @retry(
+        stop=stop_after_attempt(WEBHOOK_ATTEMPTS),
+        wait=_webhook_wait,
+        retry=retry_if_exception_type((WebhookRetryError, aiohttp.ClientError, asyncio.TimeoutError)),
+        reraise=True
+    )
+    async def _post_webhook(self, url, payload):
         """
-        Gérer les messages texte reçus.
+        Send a payload to an n8n webhook through the shared HTTP session.
+
+        Server errors (5xx), 429 and network errors are retried with an exponential
+        backoff, or after the Retry-After delay of a 429 or 503 response. When that
+        delay exceeds WEBHOOK_RETRY_AFTER_MAX, the delivery is abandoned. Other
+        client errors (4xx) are logged and not retried.
+
+        Args:
+            url (str): The webhook URL
+            payload (dict): The JSON payload to send
         """
-        if not self.check_timestamp(event):
-            return
-        # end if
+        async with self._session.post(
+                url,
+                data=orjson.dumps(payload),
+                headers=JSON_HEADERS
+        ) as r:
+            await r.read()
+            if r.status >= 500 or r.status == 429:
+                retry_after = None
+                if r.status in WEBHOOK_RETRY_STATUSES:
+                    retry_after = _parse_retry_after(r.headers.get("Retry-After"))
+                # end if
+                if retry_after is not None and retry_after > WEBHOOK_RETRY_AFTER_MAX:
+                    logger.error("Webhook %s asked to retry after %ss, giving up", url, retry_after)
+                    raise WebhookError(r.status)
+                # end if
+                raise WebhookRetryError(r.status, retry_after)
+            elif r.status >= 400:
+                logger.error("Webhook %s rejected the payload with HTTP %s", url, r.status)
+            # end if
+        # end async with
+    # end _post_webhook
+
+    def _enqueue_webhook(self, payload):
+        """
+        Queue a payload for delivery to the webhook without waiting for it.
 
-        # Log
-        logger.info(f"[TEXT] {event.sender} at {event.server_timestamp} vs {self.last_event_timestamp}")
-
-        payload = {
-            "type": "text",
-            "sender": event.sender,
-            "message": event.body,
-            "event_id": event.event_id,
-            "room_id": room.room_id
-        }
-        requests.post(self.bot_config["n8n"]["webhook_url"], json=payload, verify=False)
-    # end message_callback
+        Args:
+            payload (dict): The JSON payload to send
+        """
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning("Webhook queue full, dropping event %s", payload["event_id"])
+        # end try
+    # end _enqueue_webhook
+
+    async def _next_batch(self):
+        """
+        Wait for the next batch of queued payloads.
 
-    async def image_callback(self, room: MatrixRoom, event: RoomMessageImage):
+        Payloads already queued are taken first. Collection stops when
+        WEBHOOK_BATCH_MAX payloads are gathered or WEBHOOK_BATCH_DELAY has elapsed
+        since the first one.
+
+        Returns:
+            list: The payloads of the batch
         """
-        Gérer les images envoyées.
+        payloads = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WEBHOOK_BATCH_DELAY
+        while len(payloads) < WEBHOOK_BATCH_MAX:
+            try:
+                payloads.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            # end try
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # end if
+            try:
+                payloads.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+            # end try
+        # end while
+        return payloads
+    # end _next_batch
+
+    async def _batch_collector(self):
         """
-        if not self.check_timestamp(event):
-            return
+        Background task grouping queued payloads into batches for the workers.
+        """
+        while True:
+            payloads = await self._next_batch()
+            await self._batches.put({"events": payloads})
+            for _ in payloads:
+                self._queue.task_done()
+            # end for
+        # end while
+    # end _batch_collector
+
+    async def _webhook_worker(self, queue, url):
+        """
+        Background task delivering queued payloads to a webhook.
+
+        Args:
+            queue (asyncio.Queue): The queue of payloads to deliver
+            url (str): The webhook URL
+        """
+        while True:
+            payload = await queue.get()
+            try:
+                await self._post_webhook(url, payload)
+            except Exception:
+                logger.exception("Webhook delivery to %s failed", url)
+            finally:
+                queue.task_done()
+            # end try
+        # end while
+    # end _webhook_worker
+
+    def start_webhook_workers(self):
+        """
+        Start the background tasks delivering queued payloads to the webhook.
+
+        With a batch webhook, a single collector groups the queued events into
+        batches, so that a burst gives one batch instead of one per worker.
+
+        Returns:
+            list: The started tasks
+        """
+        if self._batch_webhook_url is None:
+            return [
+                asyncio.create_task(self._webhook_worker(self._queue, self._webhook_url))
+                for _ in range(WEBHOOK_WORKERS)
+            ]
         # end if
 
-        # Get HTTP URL of the image
-        media_data = self.transform_mxc_url(event.url)
+        tasks = [asyncio.create_task(self._batch_collector())]
+        tasks += [
+            asyncio.create_task(self._webhook_worker(self._batches, self._batch_webhook_url))
+            for _ in range(WEBHOOK_WORKERS)
+        ]
+        return tasks
+    # end start_webhook_workers
 
-        # Send to webhook
-        logger.info(f"[IMAGE] {event.sender}")
-        payload = {
-            "type": "image",
-            "sender": event.sender,
-            "media_url": media_data[0],
-            "event_id": event.event_id,
-            "room_id": room.room_id,
-            "media_id": media_data[1]
-        }
-        requests.post(self.bot_config["n8n"]["webhook_url"], json=payload, verify=False)
-    # end image_callback
-
-    async def audio_callback(self, room: MatrixRoom, event: RoomMessageAudio):
-        """
-        Gérer les fichiers audio.
+    async def message_callback(self, room: MatrixRoom, event: RoomMessageText):
+        """
+        Gérer les messages texte reçus.
         """
         if not self.check_timestamp(event):
             return
         # end if
 
-        audio_url = self.transform_mxc_url(event.url)
-        logger.info(f"[AUDIO] {event.sender}")
-        payload = {
-            "type": "audio",
-            "sender": event.sender,
-            "media_url": audio_url[0],
-            "event_id": event.event_id,
-            "room_id": room.room_id,
-            "media_id": audio_url[1]
-        }
-        requests.post(self.bot_config["n8n"]["webhook_url"], json=payload, verify=False)
-    # end audio_callback
+        # Log
+        logger.info("[TEXT] %s at %s vs %s", event.sender, event.server_timestamp, self.last_event_timestamp)
+
+        payload = self._tmpl_text.copy()
+        payload["sender"] = event.sender
+        payload["message"] = event.body
+        payload["event_id"] = event.event_id
+        payload["room_id"] = room.room_id
+        self._enqueue_webhook(payload)
+    # end message_callback
 
-    async def file_callback(self, room: MatrixRoom, event: RoomMessageFile):
+    async def _media_callback(self, kind: str, room: MatrixRoom, event):
         """
-        Gérer les fichiers envoyés.
+        Gérer les médias envoyés (images, fichiers audio et fichiers).
+
+        Args:
+            kind (str): The media type sent to the webhook ("image", "audio" or "file")
+            room (MatrixRoom): The room the event was sent to
+            event (nio.events.room_events.RoomMessageMedia): The media event
         """
         if not self.check_timestamp(event):
             return
         # end if
 
-        file_url = self.transform_mxc_url(event.url)
-        logger.info(f"[FILE] {event.sender}")
-        payload = {
-            "type": "file",
-            "sender": event.sender,
-            "media_url": file_url[0],
-            "event_id": event.event_id,
-            "room_id": room.room_id,
-            "media_id": file_url[1]
-        }
-        requests.post(self.bot_config["n8n"]["webhook_url"], json=payload, verify=False)
-    # end file_callback
+        # Get HTTP URL of the media
+        media_data = self.transform_mxc_url(event.url)
+        if media_data is None:
+            logger.warning("[%s] %s: invalid media URL %s", kind.upper(), event.sender, event.url)
+            return
+        # end if
+
+        # Send to webhook
+        logger.info("[%s] %s", kind.upper(), event.sender)
+        payload = self._tmpl_media[kind].copy()
+        payload["sender"] = event.sender
+        payload["media_url"] = media_data[0]
+        payload["event_id"] = event.event_id
+        payload["room_id"] = room.room_id
+        payload["media_id"] = media_data[1]
+        self._enqueue_webhook(payload)
+    # end _media_callback
 # end MatrixBot
 
 
@@ -163,27 +575,57 @@ async def main(config_path):
     Charger la configuration et démarrer le bot.
     """
     # Charger la configuration YAML
-    with open(config_path, "r") as f:
-        config = yaml.safe_load(f)
-
-    bot = MatrixBot(config)
-
-    logger.info("Connexion à Matrix...")
-    await bot.login(config["matrix"]["user_password"])
-
-    # Rejoindre la salle
-    await bot.join(config["matrix"]["room_id"])
-
-    # Ajouter les callbacks pour différents types de messages
-    bot.add_event_callback(bot.message_callback, RoomMessageText)
-    bot.add_event_callback(bot.image_callback, RoomMessageImage)
-    bot.add_event_callback(bot.audio_callback, RoomMessageAudio)
-    bot.add_event_callback(bot.file_callback, RoomMessageFile)
-
-    logger.info("Bot en écoute...")
-
-    # Boucle d'écoute
-    await bot.sync_forever(timeout=30000)
+    cfg = await load_config(config_path)
+
+    # Session HTTP partagée (keep-alive, pool de connexions) pour le webhook
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        ssl=create_ssl_context(cfg)
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            trust_env=True,
+            raise_for_status=False
+    ) as session:
+        bot = MatrixBot(cfg)
+        bot._session = session
+
+        # Tâches de livraison du webhook
+        workers = bot.start_webhook_workers()
+
+        logger.info("Connexion à Matrix...")
+        await bot.login(cfg.user_password)
+
+        # Rejoindre la salle
+        await bot.join(cfg.room_id)
+
+        # Ajouter les callbacks pour différents types de messages
+        bot.add_event_callback(bot.message_callback, RoomMessageText)
+        for event_type, kind in MEDIA_EVENT_TYPES.items():
+            bot.add_event_callback(partial(bot._media_callback, kind), event_type)
+        # end for
+
+        # Filtre de synchronisation
+        sync_filter = await bot.create_sync_filter()
+
+        logger.info("Bot en écoute...")
+
+        # Boucle d'écoute
+        try:
+            await bot.sync_forever(timeout=SYNC_TIMEOUT, sync_filter=sync_filter, full_state=False)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # end for
+            await asyncio.gather(*workers, return_exceptions=True)
+        # end try
+    # end async with
 # end main
 
 
@@ -192,8 +634,18 @@ if __name__ == "__main__":
     parser.add_argument("--config", required=True, help="Chemin vers le fichier de configuration YAML")
     args = parser.parse_args()
 
+    # uvloop.install() est déprécié à partir de Python 3.12
+    run_kwargs = {}
+    if uvloop is not None:
+        if sys.version_info >= (3, 12):
+            run_kwargs["loop_factory"] = uvloop.new_event_loop
+        else:
+            uvloop.install()
+        # end if
+    # end if
+
     try:
-        asyncio.run(main(args.config))
+        asyncio.run(main(args.config), **run_kwargs)
     except Exception as e:
         logger.exception("Erreur fatale lors de l'exécution du bot :")
 # end if